@@ -5,6 +5,23 @@ import nox
 def test(session):
     session.install("pytest", ".")
     session.run("pytest", "-ra", "--tb=native", "--verbose", "test-noaho.py")
+    # Scalar fallback of the vectorized scans, on CPUs having AVX2
+    session.run(
+        "pytest",
+        "-ra",
+        "--tb=native",
+        "--verbose",
+        "test-noaho.py",
+        env={"NOAHO_DISABLE_AVX2": "1"},
+    )
+
+
+@nox.session
+def pgo(session):
+    """Build with profile-guided optimization, then run the tests."""
+    session.install("pytest", "setuptools")
+    session.install("--no-build-isolation", ".", env={"NOAHO_PGO": "1"})
+    session.run("pytest", "-ra", "--tb=native", "--verbose", "test-noaho.py")
 
 
 @nox.session
@@ -1,11 +1,167 @@
-
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
 
 from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PGO_DATA_DIR = os.path.join(HERE, "pgo-data")
+PGO_CLANG_PROFILE = os.path.join(PGO_DATA_DIR, "default.profdata")
+
+# Representative matching workload run between the two PGO passes, on top of
+# the test suite, so that the profile is dominated by long scans.
+PGO_WORKLOAD = """
+import random
+
+from noahong import NoAho
+
+rng = random.Random(0)
+letters = "abcdefghijklmnopqrstuvwxyz "
+words = set()
+while len(words) < 5000:
+    size = rng.randint(2, 12)
+    words.add("".join(rng.choice(letters[:-1]) for _ in range(size)))
+corpus = "".join(rng.choice(letters) for _ in range(2000000))
+
+trie = NoAho()
+for i, word in enumerate(sorted(words)):
+    trie.add(word, i)
+trie.compile()
+for _ in range(3):
+    list(trie.findall_long(corpus))
+    list(trie.findall_short(corpus))
+"""
 
 extra_args = ["-std=c++11"]
 if sys.platform == "darwin":
     extra_args.append("-stdlib=libc++")
+elif sys.platform.startswith("linux"):
+    # compile() uses std::thread
+    extra_args.append("-pthread")
+
+
+class noaho_build_ext(build_ext):
+    """Optimized build, with link-time optimization where supported.
+
+    Setting NOAHO_PGO=1 enables a profile-guided build: the extension is
+    first built instrumented, then the test suite and a synthetic workload
+    are run against it, and it is finally rebuilt using the collected
+    profile.
+    """
+
+    def build_extensions(self):
+        self._add_optimization_args()
+        if os.environ.get("NOAHO_PGO") != "1":
+            return build_ext.build_extensions(self)
+        if self.compiler.compiler_type != "unix":
+            self.warn("NOAHO_PGO needs gcc or clang, ignoring")
+            return build_ext.build_extensions(self)
+
+        clang = self._is_clang()
+        shutil.rmtree(PGO_DATA_DIR, ignore_errors=True)
+        os.makedirs(PGO_DATA_DIR)
+        if clang:
+            generate = ["-fprofile-instr-generate"]
+            use = ["-fprofile-instr-use=%s" % PGO_CLANG_PROFILE]
+        else:
+            generate = ["-fprofile-generate=%s" % PGO_DATA_DIR]
+            use = ["-fprofile-use=%s" % PGO_DATA_DIR]
+            generate.append("-fprofile-correction")
+            use.append("-fprofile-correction")
+
+        base_args = []
+        for ext in self.extensions:
+            base_args.append((ext.extra_compile_args, ext.extra_link_args))
+        # Objects must be rebuilt on each pass, sources did not change.
+        self.force = True
+
+        self._add_args(base_args, generate)
+        build_ext.build_extensions(self)
+        self._train(clang)
+        self._check_profiles(clang)
+        if clang:
+            self._merge_clang_profiles()
+
+        self._add_args(base_args, use)
+        build_ext.build_extensions(self)
+
+    def _add_optimization_args(self):
+        # Python's own CFLAGS usually come with -O2, later flags win.
+        if self.compiler.compiler_type == "msvc":
+            compile_args = ["/O2", "/GL"]
+            link_args = ["/LTCG"]
+        elif self.compiler.compiler_type == "unix":
+            compile_args = ["-O3", "-flto"]
+            if not self._is_clang():
+                compile_args.append("-fno-fat-lto-objects")
+            link_args = compile_args
+        else:
+            return
+        for ext in self.extensions:
+            ext.extra_compile_args = ext.extra_compile_args + compile_args
+            ext.extra_link_args = ext.extra_link_args + link_args
+
+    def _is_clang(self):
+        try:
+            cmd = self.compiler.compiler_so[:1] + ["--version"]
+            out = subprocess.check_output(cmd)
+        except (OSError, subprocess.CalledProcessError):
+            return False
+        return b"clang" in out
+
+    def _add_args(self, base_args, args):
+        for ext, (compile_args, link_args) in zip(self.extensions, base_args):
+            ext.extra_compile_args = list(compile_args) + args
+            ext.extra_link_args = list(link_args) + args
+
+    def _train(self, clang):
+        ext_dirs = [
+            os.path.dirname(os.path.abspath(self.get_ext_fullpath(ext.name)))
+            for ext in self.extensions
+        ]
+        env = dict(os.environ)
+        ext_dirs.append(env.get("PYTHONPATH", ""))
+        env["PYTHONPATH"] = os.pathsep.join(ext_dirs)
+        if clang:
+            profraw = os.path.join(PGO_DATA_DIR, "%p.profraw")
+            env["LLVM_PROFILE_FILE"] = profraw
+        # The suite only feeds the profile, failures are reported by the
+        # regular test run. Both run away from the sources, and pytest does
+        # not prepend them to sys.path: an in-place build there would be
+        # imported instead of the instrumented one.
+        pytest = ["-m", "pytest", "-q", "-p", "no:cacheprovider"]
+        pytest += ["--import-mode=append", os.path.join(HERE, "test-noaho.py")]
+        workload = [sys.executable, "-c", PGO_WORKLOAD]
+        with tempfile.TemporaryDirectory(prefix="noahong-pgo-") as tmpdir:
+            subprocess.call([sys.executable] + pytest, cwd=tmpdir, env=env)
+            subprocess.check_call(workload, cwd=tmpdir, env=env)
+
+    def _check_profiles(self, clang):
+        suffix = ".profraw" if clang else ".gcda"
+        for _, _, names in os.walk(PGO_DATA_DIR):
+            if any(name.endswith(suffix) for name in names):
+                return
+        raise RuntimeError(
+            "no profile was written to %s, the instrumented build was "
+            "not used for training" % PGO_DATA_DIR
+        )
+
+    def _merge_clang_profiles(self):
+        if shutil.which("llvm-profdata"):
+            profdata = ["llvm-profdata"]
+        else:
+            profdata = ["xcrun", "llvm-profdata"]
+        raw = [
+            os.path.join(PGO_DATA_DIR, name)
+            for name in os.listdir(PGO_DATA_DIR)
+            if name.endswith(".profraw")
+        ]
+        merge = ["merge", "-output=%s" % PGO_CLANG_PROFILE]
+        subprocess.check_call(profdata + merge + raw)
+
 
 noaho_module = Extension(
     "noahong",
@@ -32,6 +188,7 @@ setup(
     long_description=open("README.md").read(),
     long_description_content_type="text/markdown",
     ext_modules=[noaho_module],
+    cmdclass={"build_ext": noaho_build_ext},
     classifiers=[
         "Intended Audience :: Developers",
         "Intended Audience :: Information Technology",
@@ -25,8 +25,13 @@
 //   http://www.cs.uku.fi/~kilpelai/BSA05/lectures/slides04.pdf
 
 #include "array-aho.h"
+#include <cstdlib>
+#include <cstring>
 #include <limits>
 #include <queue>
+#include <string>
+#include <system_error>
+#include <thread>
 #include <iostream>
 #include <utility>
 #include <iso646.h>
@@ -36,6 +41,21 @@
     #include <sys/mman.h>
 #endif
 #include <fcntl.h>
+// The AVX2 scan is built by gcc and clang (it uses their builtins), either
+// for every CPU when the compiler targets AVX2, or as a variant picked at
+// runtime on x86.
+#if (defined(__GNUC__) || defined(__clang__)) && defined(__AVX2__)
+    #define NOAHO_AVX2_SCAN
+    #define NOAHO_AVX2_TARGET
+#elif (defined(__GNUC__) || defined(__clang__)) && \
+      (defined(__x86_64__) || defined(__i386__))
+    #define NOAHO_AVX2_SCAN
+    #define NOAHO_AVX2_DISPATCH
+    #define NOAHO_AVX2_TARGET __attribute__((target("avx2")))
+#endif
+#ifdef NOAHO_AVX2_SCAN
+    #include <immintrin.h>
+#endif
 
 
 using namespace std;
@@ -71,9 +91,6 @@ std::ostream& operator<<(std::ostream& os, AhoCorasickTrie::Strings const& texts
    return os;
 }
 
-typedef std::pair<int32_t, PayloadT> NodePayload;
-
-
 FrozenNode::FrozenNode()
    : chars_offset(0)
    , ifailure_state(0)
@@ -82,17 +99,33 @@ FrozenNode::FrozenNode()
 {}
 
 
-Node::Index FrozenNode::child_at(const FrozenChars& chars,
-        const FrozenIndices& indices, AC_CHAR_TYPE c) const {
-  const FrozenChars::const_iterator begin = chars.begin() + chars_offset;
-  const FrozenChars::const_iterator end = begin + chars_count;
-  const FrozenChars::const_iterator child = std::lower_bound(begin, end, c);
-  if (child == end || *child != c)
+namespace {
+
+// Index of the child of <node> reached with <c>, or -1.
+template<typename NodeT, typename StateIndex>
+Node::Index find_child(const NodeT& node, const FrozenChars& chars,
+                       const std::vector<StateIndex>& indices,
+                       AC_CHAR_TYPE c) {
+  if (!node.chars_count)
+      return -1;
+  // Binary search whose steps only pick the half to keep, which compilers
+  // turn into conditional moves: whether the input char is found is hard to
+  // predict on natural text. Ends on the last char <= c, if any.
+  AC_CHAR_TYPE const* child = chars.data() + node.chars_offset;
+  size_t count = node.chars_count;
+  while (count > 1) {
+      const size_t half = count / 2;
+      child = child[half] <= c ? child + half : child;
+      count -= half;
+  }
+  if (*child != c)
       // since these are indices, 0 is valid, so invalid is < 0
       return -1;
-  return indices[child - chars.begin()];
+  return indices[child - chars.data()];
 }
 
+}  // namespace
+
 
 namespace {
 
@@ -160,11 +193,56 @@ PayloadT find_anchored_in_trie(const AbstractTrie* trie,
 }  // namespace
 
 
+// Compiled, read-only trie used for matching.
 class FrozenTrie: public AbstractTrie {
 public:
    typedef Node::Index Index;
 
-   FrozenTrie(Nodes&, std::deque<unsigned short>& length);
+   virtual PayloadT find_short(char const* s, size_t n,
+                               int* inout_start,
+                               int* out_end) const = 0;
+
+   virtual PayloadT find_longest(char const* s, size_t n,
+                                 int* inout_start,
+                                 int* out_end) const = 0;
+
+   virtual PayloadT find_anchored(char const* s, size_t n, char anchor,
+                                  int* inout_start,
+                                  int* out_end) const = 0;
+
+   virtual void findall_short(char const* s, size_t n,
+                              Matches* out) const = 0;
+
+   virtual void findall_longest(char const* s, size_t n,
+                                Matches* out) const = 0;
+
+   virtual void findall_anchored(char const* s, size_t n, char anchor,
+                                 Matches* out) const = 0;
+
+   virtual int contains(char const*, size_t n) const = 0;
+
+   virtual int num_keys() const = 0;
+
+   virtual int num_nodes() const = 0;
+
+   virtual int num_total_children() const = 0;
+
+   /// Returns either a valid ptr (including 0) or, -1 cast as a ptr.
+   virtual PayloadT get_payload(char const* s, size_t n) const = 0;
+
+   virtual void serialize(std::string* out) const = 0;
+
+   virtual ~FrozenTrie() {}
+};
+
+
+// FrozenTrie storing node indices as <StateIndex>. Most tries have less than
+// 64K nodes, and 16 bits indices make the nodes and transitions read when
+// matching 1.5 to 2 times smaller.
+template<typename StateIndex>
+class BasicFrozenTrie final: public FrozenTrie {
+public:
+   BasicFrozenTrie(Nodes&, std::deque<unsigned short>& length);
 
    PayloadT find_short(char const* s, size_t n,
                        int* inout_start,
@@ -178,6 +256,13 @@ public:
                           int* inout_start,
                           int* out_end) const;
 
+   void findall_short(char const* s, size_t n, Matches* out) const;
+
+   void findall_longest(char const* s, size_t n, Matches* out) const;
+
+   void findall_anchored(char const* s, size_t n, char anchor,
+                         Matches* out) const;
+
    int contains(char const*, size_t n) const;
 
    int num_keys() const;
@@ -186,44 +271,76 @@ public:
 
    int num_total_children() const;
 
-   /// Returns either a valid ptr (including 0) or, -1 cast as a ptr.
    PayloadT get_payload(char const* s, size_t n) const;
 
-   void write(std::string path) const;
+   void serialize(std::string* out) const;
 
-   virtual Index child_at(Index i, AC_CHAR_TYPE a) const;
-   virtual PayloadT payload_at(Index i) const;
-   virtual FrozenNode get_node(Node::Index i) const;
-   virtual ~FrozenTrie() {}
+   Index child_at(Index i, AC_CHAR_TYPE a) const;
+   PayloadT payload_at(Index i) const;
+   FrozenNode get_node(Node::Index i) const;
 
 private:
+   AC_CHAR_TYPE const* skip_to_key_start(AC_CHAR_TYPE const* c,
+                                         AC_CHAR_TYPE const* end) const;
+
+   PayloadT find_single_key(char const* s, size_t n,
+                            int* inout_start,
+                            int* out_end) const;
+
+   size_t max_matches(size_t n) const;
+
+   // Fields of FrozenNode read on every transition.
+   struct PackedNode {
+      StateIndex chars_offset;
+      int16_t chars_count;
+      unsigned short length;
+   };
+   typedef std::vector<StateIndex> StateIndices;
+
    // root is at 0 of course.
-   typedef std::vector<FrozenNode> FrozenNodes;
+   typedef std::vector<PackedNode> FrozenNodes;
    FrozenNodes nodes;
    FrozenChars chars;
-   FrozenIndices indices;
-
-   // Denormalizing payloads is a win because we often 10x more non-payload
-   // nodes than payload ones, and payload entries are only 2x more expensive.
-   std::vector<NodePayload> payloads;
+   StateIndices indices;
+
+   // Failure link of each node, only read when a transition is missing.
+   // Kept out of nodes so that more of them share a cache line.
+   StateIndices failures;
+
+   // Dense transitions of the root, where searches spend most of their time
+   // and which usually has the most children. Missing chars loop back to the
+   // root, so lookups from there never fail.
+   StateIndices root_children;
+
+   // Set of the chars starting a key, as bitmaps of their high nibble
+   // indexed by their low nibble, for high nibbles 0-7 and 8-15. This is
+   // the layout expected by the vectorized lookup in skip_to_key_start().
+   uint8_t key_starts_low[16];
+   uint8_t key_starts_high[16];
+
+   // When the trie holds a single key, plain substring search finds the
+   // same matches as the automaton, only faster. Empty otherwise.
+   std::string single_key;
+   Index single_key_node;
+
+   // Length of the shortest key, 0 for an empty trie. Matches do not
+   // overlap, so that a text has at most n / min_key_length of them.
+   unsigned short min_key_length;
+
+   // Payload of each node, -1 for none. Matches read a single entry, which
+   // beats searching a denormalized table of the nodes having a payload.
+   std::vector<PayloadT> payloads;
 };
 
 
 namespace {
 
-// Write native types to a file. No effort is made to ensure portability
+// Append native types to a string. No effort is made to ensure portability
 // meaning source and destination architectures must be the same.
 class Writer {
 public:
-    Writer(std::string path) {
-        this->fp = fopen(path.c_str(), "wb");
-        if (!this->fp) {
-            throw std::runtime_error("failed to open file: " + std::string(path));
-        }
-    }
-
-    ~Writer() {
-        fclose(this->fp);
+    Writer(std::string* out)
+        : out(out) {
     }
 
     void write_int32(int32_t value) {
@@ -243,14 +360,11 @@ public:
     }
 
     void write_bytes(const void* data, size_t len) {
-        const auto written = fwrite(data, 1, len, this->fp);
-        if (written != len) {
-            throw std::runtime_error("write failed");
-        }
+        this->out->append(static_cast<const char*>(data), len);
     }
 
 private:
-    FILE* fp;
+    std::string* out;
 };
 
 typedef unsigned short bom_t;
@@ -259,135 +373,305 @@ const bom_t BOM = 0xBABB;
 }  // namespace
 
 
-void FrozenTrie::write(std::string path) const {
+template<typename StateIndex>
+void BasicFrozenTrie<StateIndex>::serialize(std::string* out) const {
     // Serialize data structures as separate arrays. They will be more
     // expensive to read once mmapped because more pages will be touched but it
     // helps unifying the deserialization process and check all access to
     // mapped memory.
-    Writer w(path);
+    Writer w(out);
     w.write_unsigned_short(BOM);
     w.write_size_t(this->nodes.size());
-    for (const FrozenNode& n: this->nodes) {
+    for (const PackedNode& n: this->nodes) {
         w.write_int32(n.chars_offset);
     }
     w.write_size_t(this->nodes.size());
-    for (const FrozenNode& n: this->nodes) {
-        w.write_int32(n.ifailure_state);
+    for (StateIndex f: this->failures) {
+        w.write_int32(f);
     }
     w.write_size_t(this->nodes.size());
-    for (const FrozenNode& n: this->nodes) {
+    for (const PackedNode& n: this->nodes) {
         w.write_int16(n.chars_count);
     }
     w.write_size_t(this->nodes.size());
-    for (const FrozenNode& n: this->nodes) {
+    for (const PackedNode& n: this->nodes) {
         w.write_unsigned_short(n.length);
     }
 
     w.write_size_t(this->chars.size());
-    w.write_bytes(&(this->chars[0]), this->chars.size() * sizeof(AC_CHAR_TYPE));
+    w.write_bytes(this->chars.data(), this->chars.size() * sizeof(AC_CHAR_TYPE));
 
     w.write_size_t(this->indices.size());
     for (int32_t i: this->indices) {
         w.write_int32(i);
     }
 
-    w.write_size_t(this->payloads.size());
-    for (NodePayload p: this->payloads) {
-        w.write_int32(p.first);
+    // Payloads are denormalized on disk, we often have 10x more non-payload
+    // nodes than payload ones, and payload entries are only 2x more
+    // expensive.
+    size_t payloads_count = 0;
+    for (PayloadT p: this->payloads) {
+        if (p >= 0)
+            ++payloads_count;
+    }
+    w.write_size_t(payloads_count);
+    for (size_t i = 0; i < this->payloads.size(); ++i) {
+        if (this->payloads[i] >= 0)
+            w.write_int32(static_cast<int32_t>(i));
     }
-    w.write_size_t(this->payloads.size());
-    for (NodePayload p: this->payloads) {
-        w.write_int32(p.second);
+    w.write_size_t(payloads_count);
+    for (PayloadT p: this->payloads) {
+        if (p >= 0)
+            w.write_int32(p);
     }
 }
 
 
-FrozenTrie::FrozenTrie(Nodes& source_nodes,
+template<typename StateIndex>
+BasicFrozenTrie<StateIndex>::BasicFrozenTrie(Nodes& source_nodes,
         std::deque<unsigned short>& source_length) {
-   size_t payloads_count = 0;
-   size_t chars_count = 0;
-   for (size_t i = 0; i < source_nodes.size(); ++i)  {
-      const auto& n = source_nodes[i];
-      if (n.payload >= 0)
-         ++payloads_count;
-      chars_count += n.get_children().size();
+   // Nodes are renumbered in breadth-first order. Siblings then get
+   // consecutive ids, and the shallow nodes where most transitions and
+   // failures end up share the first cache lines.
+   std::vector<Index> order;
+   order.reserve(source_nodes.size());
+   order.push_back(0);
+   for (size_t i = 0; i < order.size(); ++i) {
+      const Node::Children& children = source_nodes[order[i]].get_children();
+      for (Node::Children::const_iterator it = children.begin();
+           it != children.end(); ++it) {
+         order.push_back(it->second);
+      }
+   }
+   std::vector<Index> renumbered(source_nodes.size());
+   for (size_t i = 0; i < order.size(); ++i) {
+      renumbered[order[i]] = i;
    }
-   payloads.resize(payloads_count);
-   size_t payloads_index = 0;
+
+   const size_t chars_count = order.size() - 1;
+   payloads.resize(source_nodes.size());
    chars.resize(chars_count);
    size_t chars_index = 0;
    indices.resize(chars_count);
    nodes.resize(source_nodes.size());
-   size_t nodes_index = 0;
+   failures.resize(source_nodes.size());
 
-   while (!source_nodes.empty()) {
-      const Node& n = source_nodes.front();
+   for (size_t i = 0; i < order.size(); ++i) {
+      const Node& n = source_nodes[order[i]];
       const Node::Children& n_children = n.get_children();
-      FrozenNode f;
-      f.length = source_length.front();
-      f.ifailure_state = n.ifailure_state;
+      PackedNode f;
+      f.length = source_length[order[i]];
+      failures[i] = renumbered[n.ifailure_state];
       f.chars_offset = chars_index;
       if (n_children.size() > std::numeric_limits<int16_t>::max())
          throw std::runtime_error("node children count overflow");
       f.chars_count = n_children.size();
-      nodes[nodes_index++] = f;
-
-      if (n.payload >= 0) {
-         payloads[payloads_index++] = NodePayload(
-                     static_cast<int32_t>(nodes_index - 1),
-                     n.payload);
-      }
+      payloads[i] = n.payload;
+      nodes[i] = f;
 
       Node::Children::const_iterator it;
       for (it = n_children.begin(); it != n_children.end(); ++it) {
           chars[chars_index] = it->first;
-          indices[chars_index++] = it->second;
+          indices[chars_index++] = renumbered[it->second];
       }
+   }
+   source_nodes.clear();
+   source_length.clear();
+
+   min_key_length = 0;
+   for (const PackedNode& node: nodes) {
+      if (node.length && (!min_key_length || node.length < min_key_length))
+         min_key_length = node.length;
+   }
+
+   root_children.assign(std::numeric_limits<AC_CHAR_TYPE>::max() + 1, 0);
+   // A single key makes the trie a chain, the key is spelled along it.
+   // Lengths wrap at 64K though, so that the count of keys alone can miss
+   // some: only a chain ending with a leaf of the chain's length qualifies.
+   single_key_node = 0;
+   if (num_keys() == 1) {
+      Index inode = 0;
+      while (nodes[inode].chars_count == 1) {
+         const int32_t offset = nodes[inode].chars_offset;
+         single_key.push_back(static_cast<char>(chars[offset]));
+         inode = indices[offset];
+      }
+      if (nodes[inode].chars_count == 0 &&
+          nodes[inode].length == single_key.size()) {
+         single_key_node = inode;
+      } else {
+         single_key.clear();
+      }
+   }
+
+   std::fill(key_starts_low, key_starts_low + 16, 0);
+   std::fill(key_starts_high, key_starts_high + 16, 0);
+   const PackedNode& root = nodes[0];
+   for (int32_t i = root.chars_offset;
+        i < root.chars_offset + root.chars_count; ++i) {
+      const AC_CHAR_TYPE c = chars[i];
+      root_children[c] = indices[i];
+      if (c < 0x80)
+         key_starts_low[c & 0x0F] |= 1 << (c >> 4);
+      else
+         key_starts_high[c & 0x0F] |= 1 << ((c >> 4) - 8);
+   }
+}
+
 
-      source_nodes.pop_front();
-      source_length.pop_front();
+namespace {
+
+#ifdef NOAHO_AVX2_SCAN
+// Vectorized part of skip_to_key_start(): returns the first key start found
+// in the whole 32 chars blocks of [c, end), or the start of the tail.
+NOAHO_AVX2_TARGET
+AC_CHAR_TYPE const* skip_blocks_avx2(AC_CHAR_TYPE const* c,
+                                     AC_CHAR_TYPE const* end,
+                                     const uint8_t* key_starts_low,
+                                     const uint8_t* key_starts_high) {
+   // Classic nibble lookup: the low nibble of each char selects its row in
+   // key_starts_{low,high}, the high nibble selects both the table and the
+   // bit to test in that row.
+   const __m256i nibble_mask = _mm256_set1_epi8(0x0F);
+   const __m256i low = _mm256_broadcastsi128_si256(
+      _mm_loadu_si128(reinterpret_cast<const __m128i*>(key_starts_low)));
+   const __m256i high = _mm256_broadcastsi128_si256(
+      _mm_loadu_si128(reinterpret_cast<const __m128i*>(key_starts_high)));
+   const __m256i bits = _mm256_setr_epi8(
+      1, 2, 4, 8, 16, 32, 64, -128, 1, 2, 4, 8, 16, 32, 64, -128,
+      1, 2, 4, 8, 16, 32, 64, -128, 1, 2, 4, 8, 16, 32, 64, -128);
+   for (; end - c >= 32; c += 32) {
+      const __m256i v = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(c));
+      const __m256i lo = _mm256_and_si256(v, nibble_mask);
+      const __m256i hi = _mm256_and_si256(_mm256_srli_epi16(v, 4), nibble_mask);
+      // Bit 3 of the high nibble, moved to bit 7, picks the table.
+      const __m256i row = _mm256_blendv_epi8(
+         _mm256_shuffle_epi8(low, lo),
+         _mm256_shuffle_epi8(high, lo),
+         _mm256_slli_epi16(hi, 4));
+      const __m256i bit = _mm256_shuffle_epi8(bits, hi);
+      const __m256i hit = _mm256_cmpeq_epi8(_mm256_and_si256(row, bit), bit);
+      const uint32_t mask = static_cast<uint32_t>(_mm256_movemask_epi8(hit));
+      if (mask)
+         return c + __builtin_ctz(mask);
    }
+   return c;
+}
+#endif
+
+#ifdef NOAHO_AVX2_SCAN
+bool detect_avx2() {
+   // Lets the tests cover the scalar scan on CPUs having AVX2.
+   const char* disable = getenv("NOAHO_DISABLE_AVX2");
+   if (disable && *disable && strcmp(disable, "0") != 0)
+      return false;
+#ifdef NOAHO_AVX2_DISPATCH
+   __builtin_cpu_init();
+   return __builtin_cpu_supports("avx2");
+#else
+   return true;
+#endif
 }
 
+// Resolved once at load time, so wheels built for any x86 CPU still use
+// AVX2 where it is available.
+const bool has_avx2 = detect_avx2();
+#endif
+
+}  // namespace
+
 
-Node::Index FrozenTrie::child_at(Index i, AC_CHAR_TYPE a) const {
-    Index ichild = nodes[i].child_at(chars, indices, a);
+// Returns the first char in [c, end) that starts a key, or end. While in the
+// root, every other char leaves the automaton in the root and can be skipped.
+template<typename StateIndex>
+AC_CHAR_TYPE const* BasicFrozenTrie<StateIndex>::skip_to_key_start(
+        AC_CHAR_TYPE const* c, AC_CHAR_TYPE const* end) const {
+#ifdef NOAHO_AVX2_SCAN
+   if (has_avx2)
+      c = skip_blocks_avx2(c, end, key_starts_low, key_starts_high);
+#endif
+   while (c < end && !root_children[*c])
+      ++c;
+   return c;
+}
+
+
+template<typename StateIndex>
+Node::Index BasicFrozenTrie<StateIndex>::child_at(Index i,
+                                                  AC_CHAR_TYPE a) const {
     // The root is a special case - every char that's not an actual
     // child of the root, points back to the root.
-    if (ichild < 0 && i == 0)
-        ichild = 0;
-    return ichild;
+    if (i == 0)
+        return root_children[a];
+    return find_child(nodes[i], chars, indices, a);
 }
 
 
-PayloadT FrozenTrie::payload_at(Index i) const {
+template<typename StateIndex>
+PayloadT BasicFrozenTrie<StateIndex>::payload_at(Index i) const {
     if (i <= 0)
         return -1;
-    const auto it = std::lower_bound(payloads.begin(), payloads.end(),
-            NodePayload(i, -1));
-    if (it == payloads.end() || it->first != i)
-        return -1;
-    return it->second;
+    return payloads[i];
 }
 
 
-FrozenNode FrozenTrie::get_node(Node::Index i) const {
-    return nodes.at(i);
+template<typename StateIndex>
+FrozenNode BasicFrozenTrie<StateIndex>::get_node(Node::Index i) const {
+    const PackedNode& packed = nodes.at(i);
+    FrozenNode n;
+    n.chars_offset = packed.chars_offset;
+    n.ifailure_state = failures.at(i);
+    n.chars_count = packed.chars_count;
+    n.length = packed.length;
+    return n;
 }
 
 
-PayloadT FrozenTrie::find_short(char const* char_s, size_t n,
-                                int* inout_istart,
-                                int* out_iend) const {
+template<typename StateIndex>
+PayloadT BasicFrozenTrie<StateIndex>::find_single_key(char const* char_s,
+                                                      size_t n,
+                                                      int* inout_istart,
+                                                      int* out_iend) const {
+   char const* start = char_s + *inout_istart;
+   char const* end = char_s + n;
+#ifdef _WIN32
+   char const* found = std::search(start, end,
+                                   single_key.begin(), single_key.end());
+   if (found == end)
+      return -1;
+#else
+   char const* found = static_cast<char const*>(
+      memmem(start, end - start, single_key.data(), single_key.size()));
+   if (!found)
+      return -1;
+#endif
+   *inout_istart = found - char_s;
+   *out_iend = *inout_istart + single_key.size();
+   return payload_at(single_key_node);
+}
+
+
+template<typename StateIndex>
+PayloadT BasicFrozenTrie<StateIndex>::find_short(char const* char_s, size_t n,
+                                                 int* inout_istart,
+                                                 int* out_iend) const {
+   if (!single_key.empty())
+      return find_single_key(char_s, n, inout_istart, out_iend);
+
    Index istate = 0;
    AC_CHAR_TYPE const* original_start = reinterpret_cast<AC_CHAR_TYPE const*>(char_s);
    AC_CHAR_TYPE const* start = original_start + *inout_istart;
    AC_CHAR_TYPE const* end = original_start + n;
 
    for (AC_CHAR_TYPE const* c = start; c < end; ++c) {
+      if (istate == 0) {
+         c = skip_to_key_start(c, end);
+         if (c == end)
+            break;
+      }
       Index ichild = this->child_at(istate, *c);
       while (ichild < 0) {
-         istate = nodes[istate].ifailure_state;
+         istate = failures[istate];
          ichild = this->child_at(istate, *c);
       }
 
@@ -419,9 +703,14 @@ PayloadT FrozenTrie::find_short(char const* char_s, size_t n,
  * looks through all contiguous matches to find the longest one before returning
  * anything.
  */
-PayloadT FrozenTrie::find_longest(char const* char_s, size_t n,
-                                  int* inout_istart,
-                                  int* out_iend) const {
+template<typename StateIndex>
+PayloadT BasicFrozenTrie<StateIndex>::find_longest(char const* char_s, size_t n,
+                                                   int* inout_istart,
+                                                   int* out_iend) const {
+   // With a single key, the first match is also the longest one.
+   if (!single_key.empty())
+      return find_single_key(char_s, n, inout_istart, out_iend);
+
    // longest terminal length, among a contiguous bunch of terminals.
    int length_longest = -1;
    int end_longest = -1;
@@ -435,12 +724,17 @@ PayloadT FrozenTrie::find_longest(char const* char_s, size_t n,
    AC_CHAR_TYPE const* end = original_start + n;
 
    for (AC_CHAR_TYPE const* c = start; c < end; ++c) {
+      if (istate == 0) {
+         c = skip_to_key_start(c, end);
+         if (c == end)
+            break;
+      }
       Index ichild = this->child_at(istate, *c);
       while (ichild < 0) {
          if (have_match) {
             goto success;
          }
-         istate = nodes[istate].ifailure_state;
+         istate = failures[istate];
          ichild = this->child_at(istate, *c);
       }
 
@@ -466,18 +760,83 @@ success:
 }
 
 
-PayloadT FrozenTrie::find_anchored(char const* char_s, size_t n, char anchor,
-                                   int* inout_istart,
-                                   int* out_iend) const {
+template<typename StateIndex>
+PayloadT BasicFrozenTrie<StateIndex>::find_anchored(char const* char_s,
+                                                    size_t n,
+                                                    char anchor,
+                                                    int* inout_istart,
+                                                    int* out_iend) const {
    return find_anchored_in_trie(this, char_s, n, anchor, inout_istart, out_iend);
 }
 
 
-int FrozenTrie::contains(char const* char_s, size_t n) const {
+namespace {
+
+// Same traversal as the Python iterators used to do: each search resumes at
+// the end of the previous match, and stops when the bounds are left
+// untouched.
+template<typename Find>
+void collect_matches(Find find, size_t max_matches, Matches* out) {
+   // Growing the output from empty would copy it log2(matches) times.
+   // Capped as matches are usually much sparser than the bound, only
+   // dense ones grow past the reservation.
+   out->reserve(out->size() + std::min(max_matches, size_t(4096)));
+   Match m;
+   m.start = 0;
+   m.end = 0;
+   for (;;) {
+      m.payload = find(&m.start, &m.end);
+      if (m.start >= m.end)
+         break;
+      out->push_back(m);
+      m.start = m.end;
+   }
+}
+
+}  // namespace
+
+
+template<typename StateIndex>
+size_t BasicFrozenTrie<StateIndex>::max_matches(size_t n) const {
+   return min_key_length ? n / min_key_length : 0;
+}
+
+
+template<typename StateIndex>
+void BasicFrozenTrie<StateIndex>::findall_short(char const* char_s, size_t n,
+                                                Matches* out) const {
+   collect_matches([&](int* inout_istart, int* out_iend) {
+      return find_short(char_s, n, inout_istart, out_iend);
+   }, max_matches(n), out);
+}
+
+
+template<typename StateIndex>
+void BasicFrozenTrie<StateIndex>::findall_longest(char const* char_s, size_t n,
+                                                  Matches* out) const {
+   collect_matches([&](int* inout_istart, int* out_iend) {
+      return find_longest(char_s, n, inout_istart, out_iend);
+   }, max_matches(n), out);
+}
+
+
+template<typename StateIndex>
+void BasicFrozenTrie<StateIndex>::findall_anchored(char const* char_s,
+                                                   size_t n,
+                                                   char anchor,
+                                                   Matches* out) const {
+   collect_matches([&](int* inout_istart, int* out_iend) {
+      return find_anchored(char_s, n, anchor, inout_istart, out_iend);
+   }, max_matches(n), out);
+}
+
+
+template<typename StateIndex>
+int BasicFrozenTrie<StateIndex>::contains(char const* char_s, size_t n) const {
    AC_CHAR_TYPE const* c = reinterpret_cast<AC_CHAR_TYPE const*>(char_s);
    Index inode = 0;
    for (size_t i = 0; i < n; ++i, ++c) {
-      inode = nodes[inode].child_at(chars, indices, *c);
+      inode = find_child(nodes[inode], chars, indices, *c);
       if (inode < 0) {
          return 0;
       }
@@ -487,11 +846,11 @@ int FrozenTrie::contains(char const* char_s, size_t n) const {
 }
 
 
-int FrozenTrie::num_keys() const {
+template<typename StateIndex>
+int BasicFrozenTrie<StateIndex>::num_keys() const {
    int num = 0;
-   for (FrozenNodes::const_iterator it = nodes.begin(), end = nodes.end();
-        it != end; ++it) {
-      if (it->length)
+   for (const PackedNode& node: nodes) {
+      if (node.length)
          ++num;
    }
 
@@ -499,23 +858,27 @@ int FrozenTrie::num_keys() const {
 }
 
 
-int FrozenTrie::num_total_children() const {
+template<typename StateIndex>
+int BasicFrozenTrie<StateIndex>::num_total_children() const {
    return chars.size();
 }
 
 
-int FrozenTrie::num_nodes() const {
+template<typename StateIndex>
+int BasicFrozenTrie<StateIndex>::num_nodes() const {
    return nodes.size();
 }
 
 
-PayloadT FrozenTrie::get_payload(char const* s, size_t n) const {
+template<typename StateIndex>
+PayloadT BasicFrozenTrie<StateIndex>::get_payload(char const* s,
+                                                  size_t n) const {
    AC_CHAR_TYPE const* utf8 = (AC_CHAR_TYPE const*)s;
    AC_CHAR_TYPE const* u = utf8;
 
    Node::Index inode = 0;
    for (u = utf8; u < utf8 + n; ++u) {
-      inode = nodes[inode].child_at(chars, indices, *u);
+      inode = find_child(nodes[inode], chars, indices, *u);
       if (inode < 0)
          return (PayloadT)-1;
    }
@@ -602,7 +965,12 @@ void AhoCorasickTrie::compile() {
    if (frozen)
       return;
    make_failure_links();
-   frozen.reset(new FrozenTrie(nodes, lengths));
+   // A trie has one transition less than nodes, so that node and chars
+   // indices both fit in 16 bits below 64K nodes.
+   if (nodes.size() <= size_t(std::numeric_limits<uint16_t>::max()) + 1)
+      frozen.reset(new BasicFrozenTrie<uint16_t>(nodes, lengths));
+   else
+      frozen.reset(new BasicFrozenTrie<int32_t>(nodes, lengths));
 }
 
 
@@ -612,39 +980,91 @@ PayloadT AhoCorasickTrie::get_payload(char const* s, size_t n) const {
 }
 
 
+namespace {
+
+// Calls fn(begin, end) on contiguous chunks covering [0, count), spread over
+// several threads when there is enough work to pay for starting them.
+template<typename Fn>
+void parallel_for(size_t count, Fn fn) {
+   const size_t min_chunk = 1 << 14;
+   size_t num_threads = std::min<size_t>(
+      std::thread::hardware_concurrency(), count / min_chunk);
+   // Lets the tests run the threaded path on small inputs and single CPUs.
+   const char* forced = getenv("NOAHO_COMPILE_THREADS");
+   if (forced && *forced)
+      num_threads = strtoul(forced, NULL, 10);
+   if (num_threads <= 1) {
+      fn(0, count);
+      return;
+   }
+   const size_t chunk = (count + num_threads - 1) / num_threads;
+   std::vector<std::thread> threads;
+   for (size_t begin = chunk; begin < count; begin += chunk) {
+      const size_t end = std::min(begin + chunk, count);
+      try {
+         threads.push_back(std::thread(fn, begin, end));
+      } catch (const std::system_error&) {
+         fn(begin, end);
+      }
+   }
+   fn(0, chunk);
+   for (std::thread& t: threads) {
+      t.join();
+   }
+}
+
+}  // namespace
+
+
 // After:
 //   http://www.quretec.com/u/vilo/edu/2005-06/Text_Algorithms/index.cgi?f=L2_Multiple_String&p=ACpre
+//
+// Goes through the trie one level at a time. The failure links of a level
+// only depend on those of shallower levels, so the nodes of a level can be
+// processed in parallel.
 void AhoCorasickTrie::make_failure_links() {
-   queue<Node*> q;
+   std::vector<Index> level;
    const Node::Children& children = nodes[Index(0)].get_children();
    for (Node::Children::const_iterator i = children.begin(),
            end = children.end();
         i != end; ++i) {
-      Node* child = &nodes[i->second];
-      q.push(child);
-      child->ifailure_state = (Index)0;
+      level.push_back(i->second);
+      nodes[i->second].ifailure_state = (Index)0;
    }
    // root fails to root
    nodes[0].ifailure_state = 0;
 
-   while (not q.empty()) {
-      Node* r = q.front();
-      q.pop();
-      const Node::Children& children = r->get_children();
-      for (Node::Children::const_iterator is = children.begin(),
-              end = children.end();
-           is != end; ++is) {
-         AC_CHAR_TYPE a = is->first;
-         Node* s = &nodes[is->second];
-         q.push(s);
-         Index ifail_state = r->ifailure_state;
-         Index ifail_child = this->child_at(ifail_state, a);
-         while (not is_valid(ifail_child)) {
-            ifail_state = nodes[ifail_state].ifailure_state;
-            ifail_child = this->child_at(ifail_state, a);
+   std::vector<Index> next_level;
+   while (not level.empty()) {
+      parallel_for(level.size(), [&](size_t begin, size_t end) {
+         for (size_t ir = begin; ir < end; ++ir) {
+            const Node& r = nodes[level[ir]];
+            const Node::Children& children = r.get_children();
+            for (Node::Children::const_iterator is = children.begin(),
+                    end = children.end();
+                 is != end; ++is) {
+               AC_CHAR_TYPE a = is->first;
+               Index ifail_state = r.ifailure_state;
+               Index ifail_child = this->child_at(ifail_state, a);
+               while (not is_valid(ifail_child)) {
+                  ifail_state = nodes[ifail_state].ifailure_state;
+                  ifail_child = this->child_at(ifail_state, a);
+               }
+               nodes[is->second].ifailure_state = ifail_child;
+            }
+         }
+      });
+
+      next_level.clear();
+      for (Index ir: level) {
+         const Node::Children& children = nodes[ir].get_children();
+         for (Node::Children::const_iterator is = children.begin(),
+                 end = children.end();
+              is != end; ++is) {
+            next_level.push_back(is->second);
          }
-         s->ifailure_state = ifail_child;
       }
+      level.swap(next_level);
    }
 }
 
@@ -717,6 +1137,27 @@ PayloadT AhoCorasickTrie::find_anchored(char const* char_s, size_t n, char ancho
 }
 
 
+void AhoCorasickTrie::findall_short(char const* char_s, size_t n,
+                                    Matches* out) const {
+   assert_compiled();
+   frozen->findall_short(char_s, n, out);
+}
+
+
+void AhoCorasickTrie::findall_longest(char const* char_s, size_t n,
+                                      Matches* out) const {
+   assert_compiled();
+   frozen->findall_longest(char_s, n, out);
+}
+
+
+void AhoCorasickTrie::findall_anchored(char const* char_s, size_t n,
+                                       char anchor, Matches* out) const {
+   assert_compiled();
+   frozen->findall_anchored(char_s, n, anchor, out);
+}
+
+
 // For debugging.
 void AhoCorasickTrie::print() const {
    typedef pair<AC_CHAR_TYPE, Index> Pair;
@@ -749,8 +1190,25 @@ void AhoCorasickTrie::print() const {
 
 
 void AhoCorasickTrie::write(char const* path, size_t n) const {
+    std::string data;
+    serialize(&data);
+
+    const std::string p(path, n);
+    FILE* fp = fopen(p.c_str(), "wb");
+    if (!fp) {
+        throw std::runtime_error("failed to open file: " + p);
+    }
+    const size_t written = fwrite(data.data(), 1, data.size(), fp);
+    // Buffered data is only flushed by fclose().
+    if (fclose(fp) != 0 || written != data.size()) {
+        throw std::runtime_error("write failed");
+    }
+}
+
+
+void AhoCorasickTrie::serialize(std::string* out) const {
     assert_compiled();
-    this->frozen->write(std::string(path, n));
+    this->frozen->serialize(out);
 }
 
 
@@ -779,13 +1237,21 @@ int32_t Utf8CodePoints::get_codepoint_index(int byte_index) const {
 
 // Check access to an array of primitive values starting at base. The memory
 // block starts with the number of elements as a size_t, followed by packed
-// elements.
+// elements, and must end before limit.
 template<typename Type>
 class MappedArray {
 public:
-    MappedArray(const uint8_t* base) {
+    MappedArray(const uint8_t* base, const uint8_t* limit) {
+        if (static_cast<size_t>(limit - base) < sizeof(size_)) {
+            throw std::runtime_error("truncated array size");
+        }
         size_ = *reinterpret_cast<const size_t*>(base);
-        begin_ = reinterpret_cast<const Type*>(base + sizeof(size_));
+        base += sizeof(size_);
+        // Divide rather than multiply the size read, which can be anything.
+        if (size_ > static_cast<size_t>(limit - base) / sizeof(Type)) {
+            throw std::runtime_error("truncated array");
+        }
+        begin_ = reinterpret_cast<const Type*>(base);
     }
 
     size_t size() const {
@@ -804,7 +1270,10 @@ public:
     }
 
     Type get(size_t index) const {
-        return *this->ptr(index);
+        if (index >= size_) {
+            throw std::runtime_error("index out of range");
+        }
+        return begin_[index];
     }
 
 private:
@@ -814,9 +1283,34 @@ private:
 };
 
 
+MappedTrie::MappedTrie()
+    : fd(0)
+    , mapped(0)
+    , borrowed(false)
+    , mapped_size(0) {
+#ifdef _WIN32
+    this->FileMapping = NULL;
+#endif
+}
+
+
+MappedTrie* MappedTrie::from_buffer(char const* data, size_t n) {
+    if (n < sizeof(BOM)) {
+        throw std::runtime_error("BOM is missing");
+    }
+    std::unique_ptr<MappedTrie> trie(new MappedTrie());
+    trie->mapped = reinterpret_cast<const uint8_t*>(data);
+    trie->borrowed = true;
+    trie->mapped_size = n;
+    trie->load();
+    return trie.release();
+}
+
+
 MappedTrie::MappedTrie(char* const path, size_t n)
     : fd(0)
     , mapped(0)
+    , borrowed(false)
     , mapped_size(0) {
 
     std::string p(path, n);
@@ -834,6 +1328,10 @@ MappedTrie::MappedTrie(char* const path, size_t n)
         throw std::runtime_error("failed to open file: " + p);
     }
     this->mapped_size = lseek(this->fd, 0, SEEK_END);
+    if (this->mapped_size < static_cast<off_t>(sizeof(BOM))) {
+        cleanup();
+        throw std::runtime_error("BOM is missing");
+    }
 
     void *addr;
 #if _WIN32
@@ -846,32 +1344,60 @@ MappedTrie::MappedTrie(char* const path, size_t n)
         NULL);
     addr = MapViewOfFile(this->FileMapping, FILE_MAP_READ, 0, 0, 0);
 #else
-    addr = mmap(0, this->mapped_size, PROT_READ, MAP_SHARED, this->fd, 0);
+    int flags = MAP_PRIVATE;
+#ifdef MAP_POPULATE
+    // Fault the whole trie in now rather than on first lookups.
+    flags |= MAP_POPULATE;
+#endif
+    addr = mmap(0, this->mapped_size, PROT_READ, flags, this->fd, 0);
+    if (addr == MAP_FAILED) {
+        addr = 0;
+    } else {
+        // Lookups jump around the whole file, so ask for read-ahead of all
+        // of it rather than sequential access.
+        madvise(addr, this->mapped_size, MADV_WILLNEED);
+    }
 #endif
     this->mapped = static_cast<const uint8_t*>(addr);
-
-    if (static_cast<size_t>(this->mapped_size) < sizeof(BOM)) {
+    if (!this->mapped) {
         cleanup();
-        throw std::runtime_error("BOM is missing");
+        throw std::runtime_error("failed to map file: " + p);
     }
+    load();
+}
+
+
+// Checks the BOM and locates the arrays in mapped[0:mapped_size].
+void MappedTrie::load() {
     const bom_t bom = *reinterpret_cast<const bom_t*>(this->mapped);
     if (bom != BOM) {
         cleanup();
         throw std::runtime_error("BOM does not match");
     }
     const auto mapped = this->mapped + sizeof(bom);
-
-    this->nodes_chars_offset.reset(new MappedArray<int32_t>(mapped));
-    this->nodes_ifailure_state.reset(new MappedArray<int32_t>(
-        this->nodes_chars_offset->end_bytes()));
-    this->nodes_chars_count.reset(new MappedArray<int16_t>(
-        this->nodes_ifailure_state->end_bytes()));
-    this->nodes_length.reset(new MappedArray<unsigned short>(
-        this->nodes_chars_count->end_bytes()));
-    this->chars.reset(new MappedArray<AC_CHAR_TYPE>(this->nodes_length->end_bytes()));
-    this->indices.reset(new MappedArray<int32_t>(this->chars->end_bytes()));
-    this->payload_keys.reset(new MappedArray<int32_t>(this->indices->end_bytes()));
-    this->payload_values.reset(new MappedArray<int32_t>(this->payload_keys->end_bytes()));
+    const auto limit = this->mapped + this->mapped_size;
+
+    try {
+        this->nodes_chars_offset.reset(new MappedArray<int32_t>(
+            mapped, limit));
+        this->nodes_ifailure_state.reset(new MappedArray<int32_t>(
+            this->nodes_chars_offset->end_bytes(), limit));
+        this->nodes_chars_count.reset(new MappedArray<int16_t>(
+            this->nodes_ifailure_state->end_bytes(), limit));
+        this->nodes_length.reset(new MappedArray<unsigned short>(
+            this->nodes_chars_count->end_bytes(), limit));
+        this->chars.reset(new MappedArray<AC_CHAR_TYPE>(
+            this->nodes_length->end_bytes(), limit));
+        this->indices.reset(new MappedArray<int32_t>(
+            this->chars->end_bytes(), limit));
+        this->payload_keys.reset(new MappedArray<int32_t>(
+            this->indices->end_bytes(), limit));
+        this->payload_values.reset(new MappedArray<int32_t>(
+            this->payload_keys->end_bytes(), limit));
+    } catch (...) {
+        cleanup();
+        throw;
+    }
 
     const size_t read = this->payload_values->end_bytes() - this->mapped;
     if (read != static_cast<size_t>(this->mapped_size)) {
@@ -882,6 +1408,9 @@ MappedTrie::MappedTrie(char* const path, size_t n)
 
 
 void MappedTrie::cleanup() {
+    if (this->borrowed) {
+        return;
+    }
 #ifdef _WIN32
     if (this->mapped) {
         UnmapViewOfFile(this->mapped);
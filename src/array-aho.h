@@ -37,6 +37,7 @@
 #include <iosfwd>
 #include <deque>
 #include <memory>
+#include <string>
 #ifdef _WIN32
     #include <io.h>
 #else
@@ -57,7 +58,50 @@ struct Node {
    {}
 
    typedef std::pair<AC_CHAR_TYPE, Index> Child;
-   typedef std::vector<Child> Children;
+
+   // Sorted children. Most nodes of a trie have a single child, so the
+   // first one is stored inline and an array is only allocated from the
+   // second one on, sparing a tiny allocation per node when adding keys.
+   class Children {
+   public:
+      typedef Child* iterator;
+      typedef const Child* const_iterator;
+
+      Children() : count(0) {}
+
+      iterator begin() {
+         return more.empty() ? &first : more.data();
+      }
+      iterator end() {
+         return begin() + count;
+      }
+      const_iterator begin() const {
+         return more.empty() ? &first : more.data();
+      }
+      const_iterator end() const {
+         return begin() + count;
+      }
+      size_t size() const {
+         return count;
+      }
+
+      void insert(iterator pos, Child child) {
+         const size_t offset = pos - begin();
+         if (count == 0) {
+            first = child;
+         } else {
+            if (more.empty())
+               more.push_back(first);
+            more.insert(more.begin() + offset, child);
+         }
+         ++count;
+      }
+
+   private:
+      Child first;
+      std::vector<Child> more;
+      uint16_t count;
+   };
 
    Index child_at(AC_CHAR_TYPE c) const {
       Children::const_iterator child = std::lower_bound(
@@ -92,6 +136,14 @@ private:
 
 std::ostream& operator<<(std::ostream& os, Node const& node);
 
+// A single key match, as byte offsets into the searched text.
+struct Match {
+   int start;
+   int end;
+   PayloadT payload;
+};
+typedef std::vector<Match> Matches;
+
 class FrozenTrie;
 typedef std::deque<Node> Nodes;
 
@@ -119,6 +171,15 @@ public:
                           int* inout_start,
                           int* out_end) const;
 
+   /// findall_* append all the successive non-overlapping matches of the
+   /// matching find_* in s to <out>.
+   void findall_short(char const* s, size_t n, Matches* out) const;
+
+   void findall_longest(char const* s, size_t n, Matches* out) const;
+
+   void findall_anchored(char const* s, size_t n, char anchor,
+                         Matches* out) const;
+
    // Only makes fail links but, I'm hitching on the idea from regexps.
    // You never need to use this, it's done automatically, it's just here
    // in case you want manual control.
@@ -139,6 +200,9 @@ public:
 
    void write(char const* path, size_t n) const;
 
+   /// Appends the format written by write() to <out>.
+   void serialize(std::string* out) const;
+
 
 private:
    static bool is_valid(Index ichild);
@@ -191,9 +255,6 @@ struct FrozenNode {
 
    FrozenNode();
 
-   Index child_at(const FrozenChars& chars, const FrozenIndices& indices,
-           AC_CHAR_TYPE c) const;
-
    int32_t chars_offset;
    Index ifailure_state;
    int16_t chars_count;
@@ -220,6 +281,10 @@ public:
    MappedTrie(char* const path, size_t n);
    virtual ~MappedTrie();
 
+   /// Reads a trie serialized by AhoCorasickTrie from memory, which must
+   /// outlive the returned trie.
+   static MappedTrie* from_buffer(char const* data, size_t n);
+
    PayloadT find_anchored(char const* s, size_t n, char anchored,
                           int* inout_start,
                           int* out_end) const;
@@ -231,12 +296,16 @@ public:
    virtual FrozenNode get_node(Node::Index i) const;
 
 private:
+    MappedTrie();
+    void load();
     Node::Index child_index(Node::Index i, AC_CHAR_TYPE c) const;
     void cleanup();
 
 private:
     int fd;
     const uint8_t* mapped;
+    // Whether mapped points to memory owned by someone else.
+    bool borrowed;
 #ifdef _WIN32
     HANDLE FileMapping;
 #endif
@@ -1,3 +1,4 @@
+# cython: boundscheck=False, wraparound=False, nonecheck=False, cdivision=True, language_level=3
 # Copyright (C) 2012 Jeff Donner
 #
 # Permission is hereby granted, free of charge, to any person
@@ -22,13 +23,18 @@
 
 # rm -f noaho.cpp && rm -rf build && rm -rf .objs && rm -f *.so && python3 cython_deep_build_setup.py build_ext --inplace
 
+import array
 import os
 
+cimport cython
+from cpython cimport array
 from cpython.ref cimport Py_INCREF
 from cpython.ref cimport Py_DECREF
 from cpython.version cimport PY_MAJOR_VERSION
 from libc.stdint cimport int32_t
 from libcpp cimport bool as bool_t
+from libcpp.string cimport string
+from libcpp.vector cimport vector
 
 cdef get_as_utf8(object text):
     if isinstance(text, unicode) or (PY_MAJOR_VERSION < 3 and isinstance(text, str)):
@@ -40,7 +46,22 @@ cdef get_as_utf8(object text):
     return utf8_data, len(utf8_data)
 
 
+cdef array.array int_array_template = array.array('i')
+
+
+# Typed memoryviews cannot point to an empty buffer.
+cdef inline char* buffer_data(const unsigned char[::1] buf):
+    if buf.shape[0] == 0:
+        return NULL
+    return <char*>&buf[0]
+
+
 cdef extern from "array-aho.h":
+    cdef struct Match:
+        int start
+        int end
+        int32_t payload
+
     cdef cppclass AhoCorasickTrie:
         AhoCorasickTrie()
 # http://groups.google.com/group/cython-users/browse_thread/thread/d0c57ee21a278db7/ffb90297821483d8?lnk=gst&q=map+return+object#ffb90297821483d8
@@ -52,12 +73,19 @@ cdef extern from "array-aho.h":
                          int* out_start, int* out_end) except +AssertionError
         int find_anchored(char* text, int len, char anchor,
                           int* out_start, int* out_end) except +AssertionError
+        void findall_short(char* text, int len,
+                           vector[Match]* out) nogil except +AssertionError
+        void findall_longest(char* text, int len,
+                             vector[Match]* out) nogil except +AssertionError
+        void findall_anchored(char* text, int len, char anchor,
+                              vector[Match]* out) nogil except +AssertionError
         int num_keys()
         int num_nodes()
         int num_total_children()
         int get_payload(char* text, int len) except +AssertionError
         int contains(char* text, int len) except +AssertionError
         void write(char* path, int len) except +AssertionError
+        void serialize(string* out) except +AssertionError
 
 
 cdef extern from "array-aho.h":
@@ -70,6 +98,8 @@ cdef extern from "array-aho.h":
 cdef extern from "array-aho.h":
     cdef cppclass MappedTrie:
         MappedTrie(char* path, int n) except +AssertionError
+        @staticmethod
+        MappedTrie* from_buffer(char* data, size_t n) except +AssertionError
         int find_anchored(char* text, int len, char anchor,
                           int* out_start, int* out_end) except +AssertionError
         int num_nodes()
@@ -81,11 +111,13 @@ cdef class NoAho:
     cdef AhoCorasickTrie *thisptr
     cdef object payloads_to_decref
     cdef int has_noninteger_payload
+    cdef bint compiled
 
     def __cinit__(self):
         self.thisptr = new AhoCorasickTrie()
         self.payloads_to_decref = []
         self.has_noninteger_payload = 0
+        self.compiled = False
 
     def __dealloc__(self):
         for payload in self.payloads_to_decref:
@@ -109,6 +141,14 @@ cdef class NoAho:
             raise PayloadWriteError("Cannot write a NoAho trie with non integer payload.")
         self.thisptr.write(utf8_data, num_utf8_chars)
 
+    def to_bytes(self):
+        """Returns the trie as written by write(), see Mapped.from_bytes()."""
+        cdef string out
+        if self.has_noninteger_payload:
+            raise PayloadWriteError("Cannot write a NoAho trie with non integer payload.")
+        self.thisptr.serialize(&out)
+        return out
+
     def __contains__(self, key_text):
         cdef bytes utf8_data
         cdef int num_utf8_chars
@@ -123,7 +163,7 @@ cdef class NoAho:
         payload_index = self.thisptr.get_payload(utf8_data, num_utf8_chars)
         if payload_index < 0:
             raise KeyError(text)
-        return self.payloads_to_decref[payload_index]
+        return self.payload_at(payload_index)
 
     def __setitem__(self, text, py_payload):
         self.add(text, py_payload)
@@ -158,29 +198,46 @@ cdef class NoAho:
 
     def compile(self):
         self.thisptr.compile()
+        self.compiled = True
+
+    # The C++ trie checks it too, but failing here is cheaper and avoids
+    # entering nogil sections only to raise.
+    cdef inline int _require_compiled(self) except -1:
+        if not self.compiled:
+            raise AssertionError("trie must be compiled before use")
+        return 0
+
+    cdef int32_t _find_short(self, char* data, int n,
+                             int* start, int* end) except? -2:
+        self._require_compiled()
+        start[0] = 0
+        end[0] = 0
+        return self.thisptr.find_short(data, n, start, end)
 
     def find_short(self, text):
         cdef int start, end
         cdef bytes utf8_data
         cdef int num_utf8_chars
-        cdef void* void_payload
         cdef int32_t payload_index
-        cdef object py_payload
         cdef Utf8CodePoints code_points
         utf8_data, num_utf8_chars = get_as_utf8(text)
-        start = 0
-        end = 0
-        payload_index = self.thisptr.find_short(utf8_data, num_utf8_chars,
-                                                &start, &end)
-        py_payload = None
-        if payload_index >= 0:
-            py_payload = self.payloads_to_decref[payload_index]
+        payload_index = self._find_short(utf8_data, num_utf8_chars,
+                                         &start, &end)
         if start == end:
             return None, None, None
         code_points.create(utf8_data, num_utf8_chars)
-        start = code_points.get_codepoint_index(start)
-        end = code_points.get_codepoint_index(end)
-        return start, end, py_payload
+        return (code_points.get_codepoint_index(start),
+                code_points.get_codepoint_index(end),
+                self.payload_at(payload_index))
+
+    def find_short_bytes(self, const unsigned char[::1] buf):
+        cdef int start, end
+        cdef int32_t payload_index
+        payload_index = self._find_short(buffer_data(buf), buf.shape[0],
+                                         &start, &end)
+        if start == end:
+            return None, None, None
+        return start, end, self.payload_at(payload_index)
 
     def find_long(self, text):
         cdef int start, end
@@ -189,14 +246,13 @@ cdef class NoAho:
         cdef int32_t payload_index
         cdef object py_payload
         cdef Utf8CodePoints code_points
+        self._require_compiled()
         utf8_data, num_utf8_chars = get_as_utf8(text)
         start = 0
         end = 0
         payload_index = self.thisptr.find_longest(utf8_data, num_utf8_chars,
                                                   &start, &end)
-        py_payload = None
-        if payload_index >= 0:
-            py_payload = self.payloads_to_decref[payload_index]
+        py_payload = self.payload_at(payload_index)
         if start == end:
             return None, None, None
         code_points.create(utf8_data, num_utf8_chars)
@@ -208,6 +264,7 @@ cdef class NoAho:
     def findall_short(self, text):
         cdef bytes utf8_data
         cdef int num_utf8_chars
+        self._require_compiled()
         utf8_data, num_utf8_chars = get_as_utf8(text)
         # 0 is flag for 'short'
         return AhoIterator(self, utf8_data, num_utf8_chars, 0)
@@ -215,6 +272,7 @@ cdef class NoAho:
     def findall_long(self, text):
         cdef bytes utf8_data
         cdef int num_utf8_chars
+        self._require_compiled()
         utf8_data, num_utf8_chars = get_as_utf8(text)
         # 1 is flag for 'long'
         return AhoIterator(self, utf8_data, num_utf8_chars, 1)
@@ -222,10 +280,71 @@ cdef class NoAho:
     def findall_anchored(self, text):
         cdef bytes utf8_data
         cdef int num_utf8_chars
+        self._require_compiled()
         utf8_data, num_utf8_chars = get_as_utf8(text)
         # 2 is flag for 'long'
         return AhoIterator(self, utf8_data, num_utf8_chars, 2)
 
+    def findall_long_bytes(self, const unsigned char[::1] buf):
+        cdef char* data = buffer_data(buf)
+        cdef int num_utf8_chars = buf.shape[0]
+        cdef vector[Match] matches
+        cdef Match m
+        self._require_compiled()
+        with nogil:
+            self.thisptr.findall_longest(data, num_utf8_chars, &matches)
+        return [(m.start, m.end, self.payload_at(m.payload)) for m in matches]
+
+    def findall_long_arrays(self, const unsigned char[::1] buf):
+        cdef char* data = buffer_data(buf)
+        cdef int num_utf8_chars = buf.shape[0]
+        cdef vector[Match] matches
+        cdef array.array starts, ends
+        cdef size_t i
+        cdef bint has_payload = False
+        cdef Match m
+        self._require_compiled()
+        with nogil:
+            self.thisptr.findall_longest(data, num_utf8_chars, &matches)
+        starts = array.clone(int_array_template, matches.size(), zero=False)
+        ends = array.clone(int_array_template, matches.size(), zero=False)
+        for i in range(matches.size()):
+            starts.data.as_ints[i] = matches[i].start
+            ends.data.as_ints[i] = matches[i].end
+            if matches[i].payload >= 0:
+                has_payload = True
+        if not has_payload:
+            return starts, ends, None
+        return starts, ends, [self.payload_at(m.payload) for m in matches]
+
+    def findall_long_batch(self, inputs):
+        # Holding our own references keeps the buffers alive without the GIL.
+        cdef list texts = list(inputs)
+        cdef vector[char*] data
+        cdef vector[int] lengths
+        cdef vector[vector[Match]] results
+        cdef bytes utf8_data
+        cdef size_t i
+        cdef Match m
+        self._require_compiled()
+        for utf8_data in texts:
+            data.push_back(utf8_data)
+            lengths.push_back(len(utf8_data))
+        results.resize(data.size())
+        with nogil:
+            for i in range(data.size()):
+                self.thisptr.findall_longest(data[i], lengths[i], &results[i])
+        return [[(m.start, m.end, self.payload_at(m.payload))
+                 for m in matches]
+                for matches in results]
+
+    # payloads() hands out the list, which may have been shrunk since.
+    @cython.boundscheck(True)
+    cdef object payload_at(self, int32_t payload_index):
+        if payload_index >= 0:
+            return self.payloads_to_decref[payload_index]
+        return None
+
     def payloads(self):
         return self.payloads_to_decref
 
@@ -237,19 +356,28 @@ cdef class NoAho:
 cdef class AhoIterator:
     cdef NoAho aho_obj
     cdef Utf8CodePoints code_points
-    cdef bytes utf8_data
-    cdef int num_utf8_chars
-    cdef int start, end, want_longest
+    cdef vector[Match] matches
+    cdef size_t index
 
-    def __init__(self, aho_obj, utf8_data, num_utf8_chars, want_longest):
+    def __init__(self, NoAho aho_obj, bytes utf8_data, int num_utf8_chars,
+                 int want_longest):
+        cdef AhoCorasickTrie* trie = aho_obj.thisptr
+        cdef char* data = utf8_data
         self.aho_obj = aho_obj
         self.code_points = Utf8CodePoints()
         self.code_points.create(utf8_data, num_utf8_chars)
-        self.utf8_data = utf8_data
-        self.num_utf8_chars = num_utf8_chars
-        self.start = 0
-        self.end = 0
-        self.want_longest = want_longest
+        self.index = 0
+
+        # All matches are collected up front, without holding the GIL, and
+        # only turned into Python objects as they are iterated over.
+        with nogil:
+            if want_longest == 1:
+                trie.findall_longest(data, num_utf8_chars, &self.matches)
+            elif want_longest == 2:
+                trie.findall_anchored(data, num_utf8_chars, 0x1F,
+                                      &self.matches)
+            else:
+                trie.findall_short(data, num_utf8_chars, &self.matches)
 
     # I belieeeeve we don't need a __dealloc__ here, that Cython bumps
     # Python objects (self.aho_obj when I assign, and derefs them
@@ -259,36 +387,14 @@ cdef class AhoIterator:
         return self
 
     def __next__(self):
-        cdef int32_t payload_index
-        cdef object py_payload
-        cdef int out_start, out_end
-
-        # I figured a runtime switch was worth not having 2
-        # iterator types.
-        if self.want_longest == 1:
-            payload_index = self.aho_obj.thisptr.find_longest(
-                self.utf8_data, self.num_utf8_chars,
-                &self.start, &self.end)
-        elif self.want_longest == 2:
-            payload_index = self.aho_obj.thisptr.find_anchored(
-                self.utf8_data, self.num_utf8_chars, 0x1F,
-                &self.start, &self.end)
-        else:
-            payload_index = self.aho_obj.thisptr.find_short(
-                self.utf8_data, self.num_utf8_chars,
-                &self.start, &self.end)
-
-        py_payload = None
-        if payload_index >= 0:
-            py_payload = self.aho_obj.payloads_to_decref[payload_index]
-        if self.start < self.end:
-            # set up for next time
-            out_start = self.code_points.get_codepoint_index(self.start)
-            out_end = self.code_points.get_codepoint_index(self.end)
-            self.start = self.end
-            return out_start, out_end, py_payload
-        else:
+        cdef Match m
+        if self.index >= self.matches.size():
             raise StopIteration
+        m = self.matches[self.index]
+        self.index += 1
+        return (self.code_points.get_codepoint_index(m.start),
+                self.code_points.get_codepoint_index(m.end),
+                self.aho_obj.payload_at(m.payload))
 
 
 cdef class MappedIterator:
@@ -329,13 +435,23 @@ cdef class MappedIterator:
             raise StopIteration
 
 
+# Passed as path by Mapped.from_bytes(), which sets up the trie itself.
+cdef object _from_buffer = object()
+
+
 cdef class Mapped:
     cdef MappedTrie *trie
     cdef bool_t closed
+    # Keeps the buffer of tries loaded by from_bytes() alive.
+    cdef object buffer
 
     def __cinit__(self, path):
         cdef bytes encoded_path
         cdef int num_chars
+        if path is _from_buffer:
+            self.trie = NULL
+            self.closed = True
+            return
         encoded_path = os.fsencode(path)
         num_chars = len(encoded_path)
         self.trie = new MappedTrie(encoded_path, num_chars)
@@ -345,9 +461,21 @@ cdef class Mapped:
         if not self.closed:
             del self.trie
 
+    @classmethod
+    def from_bytes(cls, const unsigned char[::1] buf):
+        """Loads a trie from the output of NoAho.to_bytes() without copying
+        it. The buffer is referenced until the trie is closed."""
+        cdef Mapped mapped = cls.__new__(cls, _from_buffer)
+        mapped.trie = MappedTrie.from_buffer(buffer_data(buf), buf.shape[0])
+        mapped.closed = False
+        mapped.buffer = buf
+        return mapped
+
     def close(self):
-        del self.trie
-        self.closed = True
+        if not self.closed:
+            del self.trie
+            self.closed = True
+            self.buffer = None
 
     def findall_anchored(self, text):
         cdef bytes utf8_data
@@ -22,6 +22,10 @@ def test_compile_before_use():
     # Cannot be used before compilation
     with pytest.raises(AssertionError):
         tree.find_short("xxxbaryyy")
+    with pytest.raises(AssertionError):
+        tree.findall_long("xxxbaryyy")
+    with pytest.raises(AssertionError):
+        tree.findall_long_batch([b"xxxbaryyy"])
     tree.compile()
     tree.find_short("xxxbaryyy")
     # Cannot add after compilation
@@ -152,6 +156,33 @@ def test_empty_construction():
     del tree
 
 
+def test_oob_safe():
+    """Bounds checks are disabled in the wrapper, empty inputs must still
+    be handled."""
+    tree = NoAho()
+    tree.add("foo")
+    tree.compile()
+    assert [] == list(tree.findall_long(""))
+    assert [] == list(tree.findall_short(""))
+    assert [] == list(tree.findall_anchored(""))
+    assert (None, None, None) == tree.find_short("")
+    assert (None, None, None) == tree.find_long("")
+    assert [] == tree.findall_long_bytes(b"")
+    assert [[]] == tree.findall_long_batch([b""])
+
+    # payloads() returns the payload list itself
+    tree = NoAho()
+    tree.add("x", "payload")
+    tree.compile()
+    tree.payloads().clear()
+    with pytest.raises(IndexError):
+        list(tree.findall_long("x"))
+    with pytest.raises(IndexError):
+        tree.find_long("x")
+    with pytest.raises(IndexError):
+        tree["x"]
+
+
 def test_embedded_nulls():
     """Check to see if we can accept embedded nulls"""
     tree = NoAho()
@@ -191,6 +222,28 @@ def test_findall_and_findall_longest():
     assert [] == list(tree.findall_long("no pascal here"))
 
 
+def test_batch_findall():
+    tree = NoAho()
+    tree.add("python")
+    tree.add("perl", 1)
+    tree.add("scheme")
+    tree.add("java", "java")
+    tree.add("pythonperl")
+    tree.add("étable")
+    tree.compile()
+    texts = ["pythonperlschemejava", "no pascal here", "", "perl and java"]
+    expected = [list(tree.findall_long(text)) for text in texts]
+    inputs = [text.encode("utf-8") for text in texts]
+    assert expected == tree.findall_long_batch(inputs)
+    assert [] == tree.findall_long_batch([])
+    # Offsets are expressed in bytes of the encoded input
+    assert [[(1, 8, None)]] == tree.findall_long_batch(
+        [" étable".encode("utf-8")]
+    )
+    with pytest.raises(TypeError):
+        tree.findall_long_batch(["python"])
+
+
 def test_bug2_competing_longests():
     """Previously we'd return the /last/ key found, now we look forward
     while there are contiguous candidate keys, and actually return the
@@ -335,6 +388,119 @@ def test_utf8():
     assert matches == [(0, 6, None), (7, 12, None), (13, 16, None)]
 
 
+def test_utf8_bytes():
+    tree = NoAho()
+    tree.add("étable")
+    tree.add("béret")
+    tree.add("blé", 3)
+    tree.compile()
+    data = "étable béret blé".encode("utf-8")
+    # Same matches as test_utf8, as byte offsets
+    matches = tree.findall_long_bytes(data)
+    assert matches == [(0, 7, None), (8, 14, None), (15, 19, 3)]
+    keys = [data[start:end].decode("utf-8") for start, end, _ in matches]
+    assert keys == ["étable", "béret", "blé"]
+    assert matches == tree.findall_long_bytes(bytearray(data))
+    assert (1, 7, None) == tree.find_short_bytes(data[7:])
+    assert (None, None, None) == tree.find_short_bytes(b"")
+    assert [] == tree.findall_long_bytes(b"")
+
+
+def test_wrapped_key_length():
+    """Key lengths are stored on 16 bits, a 64K bytes key does not make the
+    trie a single key one."""
+    tree = NoAho()
+    tree.add("b", 7)
+    tree.add("a" * 65536, 1)
+    tree.compile()
+    assert (2, 3, 7) == tree.find_short("xxbxx")
+    assert (2, 3, 7) == tree.find_long("xxbxx")
+
+
+def test_utf8_long_text():
+    """Key starts past the first 32 bytes block, around block boundaries
+    and in the tail, including non-ASCII ones."""
+    tree = NoAho()
+    tree.add("émile", 0)
+    tree.add("日本", 1)
+    tree.add("zéro", 2)
+    tree.compile()
+    for prefix in range(28, 36):
+        text = "x" * prefix + "émile" + "y" * 30 + "日本" + "y" * 30 + "zéro"
+        data = text.encode("utf-8")
+        assert len(data) >= 64
+        matches = tree.findall_long_bytes(data)
+        keys = [data[start:end].decode("utf-8") for start, end, _ in matches]
+        assert keys == ["émile", "日本", "zéro"]
+        assert [p for _, _, p in matches] == [0, 1, 2]
+        expected = [(prefix, prefix + 5, 0)]
+        expected.append((prefix + 35, prefix + 37, 1))
+        expected.append((prefix + 67, prefix + 71, 2))
+        assert list(tree.findall_long(text)) == expected
+        assert tree.find_long(text) == expected[0]
+        assert tree.find_short(text) == expected[0]
+
+
+def test_large_trie():
+    """Tries of more than 64K nodes store 32 bits indices."""
+    tree = NoAho()
+    for i in range(70000):
+        tree.add(anchor(".k%d." % (i * 7919)), i)
+    tree.compile()
+    assert tree.nodes_count() > 65536
+    keys = [anchor(".k%d." % (i * 7919)) for i in (0, 1, 65535, 69999)]
+    text = anchor(".x.").join(keys)
+    expected = [(0, 4, 0), (7, 14, 1), (17, 29, 65535), (32, 44, 69999)]
+    assert list(tree.findall_long(text)) == expected
+    assert list(tree.findall_anchored(text)) == expected
+    with contextlib.closing(Mapped.from_bytes(tree.to_bytes())) as m:
+        assert m.nodes_count() == tree.nodes_count()
+        assert list(m.findall_anchored(text)) == expected
+
+
+def test_threaded_compile(monkeypatch):
+    """Failure links computed over several threads are the same."""
+    keys = ["".join(reversed(str(i * 7919))) for i in range(3000)]
+    tries = []
+    for threads in ("1", "3"):
+        monkeypatch.setenv("NOAHO_COMPILE_THREADS", threads)
+        tree = NoAho()
+        for i, key in enumerate(keys):
+            tree.add(key, i)
+        tree.compile()
+        tries.append(tree)
+    assert tries[0].to_bytes() == tries[1].to_bytes()
+    text = "".join(keys[::7])
+    assert list(tries[0].findall_long(text)) == list(tries[1].findall_long(text))
+
+
+def test_findall_long_arrays():
+    tree = NoAho()
+    tree.add("python")
+    tree.add("perl")
+    tree.add("scheme")
+    tree.add("pythonperl")
+    tree.compile()
+    data = b"pythonperlschemejava"
+    starts, ends, payloads = tree.findall_long_arrays(data)
+    assert [0, 10] == list(starts)
+    assert [10, 16] == list(ends)
+    assert payloads is None
+    assert memoryview(starts).format == "i"
+
+    tree = NoAho()
+    tree.add("étable", 1)
+    tree.add("béret")
+    tree.compile()
+    data = "étable béret blé".encode("utf-8")
+    starts, ends, payloads = tree.findall_long_arrays(data)
+    expected = tree.findall_long_bytes(data)
+    assert expected == list(zip(starts, ends, payloads))
+
+    starts, ends, payloads = tree.findall_long_arrays(b"")
+    assert ([], [], None) == (list(starts), list(ends), payloads)
+
+
 def test_anchored():
     tree = NoAho()
     tree.add(anchor(".a..b..c."))
@@ -355,21 +521,25 @@ def test_mapped_trie():
     with tempfile.TemporaryDirectory(prefix="noahong-") as tmpdir:
         path = os.path.join(tmpdir, "mapped")
         tree.write(path)
-
-        with contextlib.closing(Mapped(path)) as m:
-            assert m.nodes_count() == tree.nodes_count()
-            matches = list(m.findall_anchored(anchor(".a..b..c.")))
-            assert matches == [(0, 9, 0)]
-            matches = list(m.findall_anchored(anchor(".b.")))
-            assert matches == [(0, 3, 1)]
-            matches = list(m.findall_anchored(anchor(".a..c.")))
-            assert matches == [(0, 6, 2)]
-            matches = list(m.findall_anchored(anchor(".z.")))
-            assert matches == []
-            matches = list(m.findall_anchored(anchor(".z..a..b..z.")))
-            assert matches == [(3, 9, 3)]
-            matches = list(m.findall_anchored(anchor(".é.")))
-            assert matches == [(0, 3, 4)]
+        with open(path, "rb") as fp:
+            data = fp.read()
+        assert tree.to_bytes() == data
+
+        for mapped in (Mapped(path), Mapped.from_bytes(data)):
+            with contextlib.closing(mapped) as m:
+                assert m.nodes_count() == tree.nodes_count()
+                matches = list(m.findall_anchored(anchor(".a..b..c.")))
+                assert matches == [(0, 9, 0)]
+                matches = list(m.findall_anchored(anchor(".b.")))
+                assert matches == [(0, 3, 1)]
+                matches = list(m.findall_anchored(anchor(".a..c.")))
+                assert matches == [(0, 6, 2)]
+                matches = list(m.findall_anchored(anchor(".z.")))
+                assert matches == []
+                matches = list(m.findall_anchored(anchor(".z..a..b..z.")))
+                assert matches == [(3, 9, 3)]
+                matches = list(m.findall_anchored(anchor(".é.")))
+                assert matches == [(0, 3, 4)]
 
 
 def test_empty_mapped_trie():
@@ -384,12 +554,20 @@ def test_empty_mapped_trie():
             assert m.nodes_count() == tree.nodes_count()
             matches = list(m.findall_anchored(anchor(".a..b..c.")))
             assert matches == []
+            # Closing twice is harmless
+            m.close()
 
 
 def test_bad_mapped_trie():
     with tempfile.TemporaryDirectory(prefix="noahong-") as tmpdir:
         path = os.path.join(tmpdir, "mapped")
 
+        # Input file is empty
+        with open(path, "wb") as fp:
+            pass
+        with pytest.raises(AssertionError):
+            Mapped(path)
+
         # Input file is too short
         with open(path, "wb") as fp:
             fp.write(b"1")
@@ -403,6 +581,23 @@ def test_bad_mapped_trie():
         with pytest.raises(AssertionError):
             Mapped(path)
 
+    with pytest.raises(TypeError):
+        Mapped()
+
+    for data in (b"", b"1", b"1234"):
+        with pytest.raises(AssertionError):
+            Mapped.from_bytes(data)
+
+    # Truncated tries
+    tree = NoAho()
+    tree.add("foo", 0)
+    tree.add("bar", 1)
+    tree.compile()
+    data = tree.to_bytes()
+    for n in range(2, len(data)):
+        with pytest.raises(AssertionError):
+            Mapped.from_bytes(data[:n])
+
 def test_mapped_trie_payload():
     trie = NoAho()
     trie.add("foo", None)